@@ -14,12 +14,10 @@ import sys
 import argparse
 import pathlib
 import datetime as dt
-from urllib.error import HTTPError
 import numpy as np
 import pandas as pd
-import wget
 import logging
-from proc_util import exec_command
+from download_util import download_files
 
 this_file = os.path.basename(__file__)
 logging.basicConfig(format=f'{this_file}: %(asctime)s - %(message)s',
@@ -31,6 +29,19 @@ long_long_time = 15
 short_time = 3
 curr_dir=os.path.dirname(os.path.abspath(__file__))
 
+def download_error(error_msg, now_time_beg):
+    log.error('ERROR: '+error_msg)
+    log.error('Check if an earlier cycle has the required files and adjust icbc_fc_dt if necessary. Exiting!')
+    now_time_end = dt.datetime.now(dt.UTC)
+    run_time_tot = now_time_end - now_time_beg
+    now_time_beg_str = now_time_beg.strftime('%Y-%m-%d %H:%M:%S')
+    now_time_end_str = now_time_end.strftime('%Y-%m-%d %H:%M:%S')
+    log.error('\nScript completed with an error.')
+    log.error('   Beg time: '+now_time_beg_str)
+    log.error('   End time: '+now_time_end_str)
+    log.error('   Run time: '+str(run_time_tot)+'\n')
+    sys.exit(1)
+
 def parse_args():
     ## Parse the command-line arguments
     parser = argparse.ArgumentParser()
@@ -67,19 +78,6 @@ def parse_args():
 
     return cycle_dt, sim_hrs, out_dir, icbc_fc_dt, resolution, int_h
 
-def wget_error(error_msg, now_time_beg):
-    log.error('ERROR: '+error_msg)
-    log.error('Check if an earlier cycle has the required files and adjust icbc_fc_dt if necessary. Exiting!')
-    now_time_end = dt.datetime.utcnow()
-    run_time_tot = now_time_end - now_time_beg
-    now_time_beg_str = now_time_beg.strftime('%Y-%m-%d %H:%M:%S')
-    now_time_end_str = now_time_end.strftime('%Y-%m-%d %H:%M:%S')
-    log.error('\nScript completed with an error.')
-    log.error('   Beg time: '+now_time_beg_str)
-    log.error('   End time: '+now_time_end_str)
-    log.error('   Run time: '+str(run_time_tot)+'\n')
-    sys.exit(1)
-
 def main(cycle_dt_str, sim_hrs, out_dir, icbc_fc_dt, resolution, now_time_beg, interval):
 
     ## Calculate the desired lead hours for this cycle, accounting for the possible icbc_fc_dt offset.
@@ -103,8 +101,13 @@ def main(cycle_dt_str, sim_hrs, out_dir, icbc_fc_dt, resolution, now_time_beg, i
     aws_dir = 'https://noaa-gfs-bdp-pds.s3.amazonaws.com/gfs.'+cycle_date+'/'+cycle_hour+'/atmos'
 
     out_dir.mkdir(parents=True, exist_ok=True)
+    # List the directory once rather than stat'ing each destination file
+    existing = {entry.name for entry in os.scandir(out_dir)}
+
+    available_files = {'pgrb2': {}}
+    missing_records = []
+    downloads = []
 
-    os.chdir(out_dir)
     ## Loop over lead times
     for ll in range(n_leads):
         this_lead = str(leads[ll]).zfill(3)
@@ -117,17 +120,24 @@ def main(cycle_dt_str, sim_hrs, out_dir, icbc_fc_dt, resolution, now_time_beg, i
             fname = 'gfs.t'+cycle_hour+'z.pgrb2.0p50.f'+this_lead
         url = aws_dir+'/'+fname
 
-        if not out_dir.joinpath(fname).is_file():
-            log.info('Downloading '+url)
-            try:
-                wget.download(url)
-                log.info('')
-            except HTTPError:
-                err_msg = 'HTTP Error 404: Not Found: ' + url
-                wget_error(str(err_msg), now_time_beg)
-        else:
-            log.info('   File '+fname+' already exists locally. Not downloading again from server.')
-
+        downloads.append(dict(
+            url=url,
+            dest=out_dir.joinpath(fname),
+            tag='pgrb2',
+            valid_time=cycle_dt + dt.timedelta(hours=int(leads[ll])),
+            label=f'lead f{this_lead}',
+            available_files=available_files,
+            missing_records=missing_records,
+            icbc_analysis=False,
+            existing=existing,
+        ))
+
+    download_files(downloads, log)
+    # A file filled in from its neighbors would keep the neighbor's forecast hour in its GRIB2 headers,
+    # so a missing forecast lead is still fatal; it is only reported once every other file has downloaded
+    if missing_records:
+        missing = ', '.join(record.destination.name for record in missing_records)
+        download_error('Could not download ' + missing, now_time_beg)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,477 @@
+'''
+download_util.py
+
+Helpers shared by the GRIB2 download scripts: pooled HTTP downloads (streamed or as parallel byte ranges),
+and wgrib2-based interpolation of files the server does not have from their downloaded neighbors.
+'''
+
+import os
+import io
+import sys
+import pathlib
+import datetime as dt
+import subprocess
+import re
+import bisect
+import shutil
+from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import urllib3
+from proc_util import exec_command
+
+# Files larger than this are fetched as several parallel byte-range GETs instead of a single stream
+ranged_min_bytes = 64 * 1024 * 1024
+ranged_parts = 8
+# Number of files downloaded concurrently; with ranged_parts this keeps every request within the pool below
+download_workers = 2
+
+# One keep-alive connection pool shared by every request in a cycle, so each file doesn't pay a new TLS handshake
+pool = urllib3.PoolManager(num_pools=2, maxsize=16, retries=urllib3.Retry(total=3, backoff_factor=0.3),
+                           headers={'Connection': 'keep-alive'})
+
+
+class IncompleteDownloadError(OSError):
+    '''The server sent fewer bytes than it said the file has.'''
+
+
+class RangeNotSupportedError(OSError):
+    '''The server answered a byte-range request with something other than 206 Partial Content.'''
+
+
+@dataclass
+class MissingFileRecord:
+    tag: str
+    valid_time: dt.datetime
+    destination: pathlib.Path
+    label: str
+    icbc_analysis: bool
+
+
+def download_files(downloads, logger):
+    '''
+    Run download_or_queue_file for each dict of keyword arguments in downloads.
+    The files are independent, so several are fetched at once over the shared connection pool.
+    '''
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        list(executor.map(lambda kwargs: download_or_queue_file(**kwargs, logger=logger), downloads))
+
+
+def download_or_queue_file(url, dest, tag, valid_time, label, available_files, missing_records, icbc_analysis, existing, logger):
+    # existing is the set of file names already present in dest's directory
+    if dest.name in existing:
+        logger.info(f'   File {dest.name} already exists locally. Not downloading again from server.')
+        record_available_file(available_files, tag, valid_time, dest)
+        return
+
+    logger.info('Downloading ' + url)
+    try:
+        content_length = get_content_length(url)
+        if content_length is not None and content_length > ranged_min_bytes:
+            try:
+                download_ranged(url, dest, parts=ranged_parts, content_length=content_length)
+            except RangeNotSupportedError as exc:
+                logger.info(f'   {exc} Downloading as a single stream instead.')
+                download_stream(url, dest, content_length=content_length)
+        else:
+            download_stream(url, dest, content_length=content_length)
+        existing.add(dest.name)
+        record_available_file(available_files, tag, valid_time, dest)
+    # urllib3.exceptions.HTTPError covers dropped connections, exhausted retries and read timeouts
+    except (HTTPError, IncompleteDownloadError, urllib3.exceptions.HTTPError) as exc:
+        logger.warning(f'Error while downloading {url}: {exc}. Marking for interpolation.')
+        missing_records.append(MissingFileRecord(
+            tag=tag,
+            valid_time=valid_time,
+            destination=dest,
+            label=label,
+            icbc_analysis=icbc_analysis,
+        ))
+
+
+def pool_request(method, url, headers=None):
+    # urllib3 does not raise on error statuses, so convert them into the HTTPError the callers already handle
+    if headers is not None:
+        headers = {**pool.headers, **headers}
+    resp = pool.request(method, url, headers=headers, preload_content=False)
+    if resp.status >= 400:
+        resp.release_conn()
+        raise HTTPError(url, resp.status, resp.reason, resp.headers, None)
+    return resp
+
+
+def get_content_length(url):
+    # A HEAD request raises HTTPError for missing objects, same as a GET would
+    resp = pool_request('HEAD', url)
+    content_length = resp.headers.get('Content-Length')
+    resp.release_conn()
+    return int(content_length) if content_length else None
+
+
+def download_stream(url, dest, content_length=None):
+    '''
+    Stream url to dest over the shared connection pool.
+    The data lands in a temporary .part file that is only renamed to dest once the transfer has completed.
+    Chunks are written unbuffered, since they are already large, and the file's pages are released from the
+    page cache afterward so big GRIB2 downloads don't crowd out other users of a shared node.
+    '''
+    tmp_dest = dest.with_suffix(dest.suffix + '.part')
+    resp = pool_request('GET', url)
+    written = 0
+    try:
+        with io.FileIO(tmp_dest, 'wb') as raw:
+            if content_length and hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(raw.fileno(), 0, content_length)
+            for chunk in resp.stream(1 << 20):
+                # Raw writes may be partial
+                view = memoryview(chunk)
+                while view:
+                    view = view[raw.write(view):]
+                written += len(chunk)
+            # The file was preallocated to content_length, so a truncated body would otherwise look complete
+            if content_length is not None and written != content_length:
+                raise IncompleteDownloadError(f'Short read for {url}: got {written} of {content_length} bytes.')
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(raw.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    except BaseException:
+        tmp_dest.unlink(missing_ok=True)
+        raise
+    finally:
+        resp.release_conn()
+    tmp_dest.replace(dest)
+
+
+def download_ranged(url, dest, parts=8, content_length=None):
+    '''
+    Download url to dest as several concurrent HTTP byte-range requests, each written in place at its offset.
+    The data lands in a temporary .part file that is only renamed to dest once every range has completed.
+    '''
+    if content_length is None:
+        content_length = get_content_length(url)
+    part_size = -(-content_length // parts)
+    bounds = [(lo, min(lo + part_size, content_length) - 1) for lo in range(0, content_length, part_size)]
+
+    def fetch_range(bound):
+        lo, hi = bound
+        offset = lo
+        resp = pool_request('GET', url, headers={'Range': f'bytes={lo}-{hi}'})
+        try:
+            if resp.status != 206:
+                raise RangeNotSupportedError(f'Server ignored byte-range request for {url} (HTTP {resp.status}).')
+            for chunk in resp.stream(1 << 20):
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+        finally:
+            resp.release_conn()
+        if offset != hi + 1:
+            raise IncompleteDownloadError(f'Short read for bytes {lo}-{hi} of {url}.')
+
+    tmp_dest = dest.with_suffix(dest.suffix + '.part')
+    fd = os.open(tmp_dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # Reserve the full file up front so the parallel writes don't fragment it
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, content_length)
+        with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+            list(executor.map(fetch_range, bounds))
+    except BaseException:
+        os.close(fd)
+        tmp_dest.unlink(missing_ok=True)
+        raise
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    os.close(fd)
+    tmp_dest.replace(dest)
+
+
+def record_available_file(available_files, tag, valid_time, path):
+    available_files.setdefault(tag, {})[valid_time] = path
+
+
+def interpolate_missing_files(available_files, missing_records, logger):
+    if not missing_records:
+        return
+
+    logger.info(f'Attempting to interpolate {len(missing_records)} missing GRIB2 files.')
+    resolved = []
+    unresolved = []
+
+    # Sort each tag's valid times once so neighbor lookups are a bisection rather than a full scan.
+    # Every missing file is bracketed by files that were actually downloaded; for linear interpolation
+    # this gives the same result as chaining through previously interpolated files.
+    sorted_times = {tag: sorted(available_files[tag].keys()) for tag in available_files}
+
+    # Files bracketed by the same pair of neighbors are interpolated together in a single wgrib2 call
+    batches = {}
+
+    for record in missing_records:
+        success = interpolate_single_file(available_files, sorted_times.get(record.tag, []), record, logger, batches)
+        if success:
+            resolved.append(record)
+        else:
+            unresolved.append(record)
+
+    for (prev_file, next_file), entries in batches.items():
+        interpolate_batch(prev_file, next_file, entries, logger)
+
+    for record in resolved:
+        record_available_file(available_files, record.tag, record.valid_time, record.destination)
+
+    if unresolved:
+        for record in unresolved:
+            logger.error(f'Unable to interpolate missing file {record.destination} ({record.label}).')
+        logger.error('Interpolation failed for some files. Exiting!')
+        sys.exit(1)
+
+
+def interpolate_single_file(available_files, sorted_times, record, logger, batches):
+    available_map = available_files.get(record.tag, {})
+    if not available_map:
+        logger.error(f'No available files of type {record.tag} to interpolate {record.destination}.')
+        return False
+
+    # sorted_times holds the keys of available_map in ascending order
+    idx = bisect.bisect_left(sorted_times, record.valid_time)
+    prev_time = sorted_times[idx - 1] if idx > 0 else None
+    if idx < len(sorted_times) and sorted_times[idx] == record.valid_time:
+        idx += 1
+    next_time = sorted_times[idx] if idx < len(sorted_times) else None
+
+    record.destination.parent.mkdir(parents=True, exist_ok=True)
+
+    if prev_time is None and next_time is None:
+        logger.error(f'No neighboring files exist to interpolate {record.destination}.')
+        return False
+    if prev_time is None:
+        shutil.copy2(available_map[next_time], record.destination)
+        logger.warning(f'Copied {available_map[next_time].name} to fill missing {record.destination.name} (no earlier neighbor).')
+        return True
+    if next_time is None:
+        shutil.copy2(available_map[prev_time], record.destination)
+        logger.warning(f'Copied {available_map[prev_time].name} to fill missing {record.destination.name} (no later neighbor).')
+        return True
+
+    prev_file = available_map[prev_time]
+    next_file = available_map[next_time]
+    total_seconds = (next_time - prev_time).total_seconds()
+    if total_seconds <= 0:
+        shutil.copy2(prev_file, record.destination)
+        logger.warning(f'Duplicate timestamps detected. Copied {prev_file.name} to {record.destination.name}.')
+        return True
+
+    weight_prev = (next_time - record.valid_time).total_seconds() / total_seconds
+    weight_next = 1.0 - weight_prev
+    logger.info(
+        f'Interpolating {record.destination.name} between {prev_file.name} and {next_file.name} '
+        f'with weights {weight_prev:.2f}/{weight_next:.2f}.'
+    )
+
+    # The actual interpolation is deferred to interpolate_batch
+    batches.setdefault((prev_file, next_file), []).append((record, weight_prev, weight_next))
+    return True
+
+
+def interpolate_batch(prev_file, next_file, entries, logger):
+    if try_wgrib2_interpolation(prev_file, next_file, entries, logger):
+        return
+
+    for record, weight_prev, weight_next in entries:
+        fallback = prev_file if weight_prev >= weight_next else next_file
+        shutil.copy2(fallback, record.destination)
+        if record.icbc_analysis:
+            if try_wgrib2_set_date(record.destination, record.valid_time, logger):
+                logger.warning(
+                    f'Copied {fallback.name} and adjusted date to {record.valid_time} for {record.destination.name}.'
+                )
+                continue
+        logger.warning(
+            f'wgrib2 interpolation unavailable; copied {fallback.name} to approximate {record.destination.name}.'
+        )
+
+
+def try_wgrib2_interpolation(prev_file, next_file, entries, logger):
+    wgrib2_exe = find_wgrib2(logger)
+    if not wgrib2_exe:
+        logger.debug('wgrib2 not found; skipping interpolation command.')
+        return False
+    prev_file = sanitize_grib2_file(prev_file, logger, replace_original=False)
+    next_file = sanitize_grib2_file(next_file, logger, replace_original=False)
+
+    # Keep both neighbors in registers, then write one weighted sum per target file from the same pass.
+    # Each expression starts from 0:* so it does not depend on the previous target's output.
+    cmd = [
+        wgrib2_exe,
+        str(prev_file),
+        '-rpn', 'sto_1',
+        '-import_grib', str(next_file),
+        '-rpn', 'sto_2',
+    ]
+    for record, weight_prev, weight_next in entries:
+        cmd += [
+            '-rpn', f'0:*:rcl_1:{weight_prev:.6f}:*:+:rcl_2:{weight_next:.6f}:*:+',
+            '-grib', str(record.destination),
+        ]
+    ret_code, _ = exec_command(cmd, logger, exit_on_fail=False, verbose=False)
+    if ret_code != 0:
+        logger.warning('wgrib2 interpolation command failed.')
+        for record, _, _ in entries:
+            if record.destination.exists():
+                try:
+                    record.destination.unlink()
+                except OSError:
+                    logger.warning(f'Unable to remove incomplete file {record.destination}.')
+        return False
+    for record, _, _ in entries:
+        if record.icbc_analysis:
+            try_wgrib2_set_date(record.destination, record.valid_time, logger)
+        sanitize_grib2_file(record.destination, logger, replace_original=True)
+    return True
+
+
+def try_wgrib2_set_date(target_file, valid_time, logger):
+    wgrib2_exe = find_wgrib2(logger)
+    if not wgrib2_exe:
+        logger.debug('wgrib2 not found; skipping set_date.')
+        return False
+    date_code = valid_time.strftime('%Y%m%d%H%M%S')
+    tmp_target = target_file.with_suffix(target_file.suffix + '.tmp')
+    cmd = [
+        wgrib2_exe,
+        str(target_file),
+        '-set_date', date_code,
+        '-grib', str(tmp_target),
+    ]
+    ret_code, _ = exec_command(cmd, logger, exit_on_fail=False, verbose=False)
+    if ret_code != 0:
+        if tmp_target.exists() and tmp_target.stat().st_size > 0:
+            logger.warning(
+                'wgrib2 set_date returned non-zero; keeping output file despite warnings.'
+            )
+            tmp_target.replace(target_file)
+            return True
+        logger.warning('wgrib2 set_date failed.')
+        if tmp_target.exists():
+            tmp_target.unlink()
+        return False
+    tmp_target.replace(target_file)
+    return True
+
+
+def sanitize_grib2_file(grib_path, logger, replace_original=False):
+    wgrib2_exe = find_wgrib2(logger)
+    if not wgrib2_exe:
+        return grib_path
+    if not pathlib.Path(grib_path).exists():
+        return grib_path
+
+    cmd = [wgrib2_exe, str(grib_path), '-s']
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    output = (result.stdout or '') + (result.stderr or '')
+    if result.returncode == 0:
+        return grib_path
+    if 'bad stat_proc' not in output and 'bad grib message' not in output and 'forecast time' not in output:
+        return grib_path
+
+    bad_rec = None
+    for line in output.splitlines():
+        if 'ASNOW' in line:
+            match = re.match(r'^\\s*(\\d+):', line)
+            if match:
+                bad_rec = int(match.group(1))
+                break
+    if bad_rec is None:
+        for line in output.splitlines():
+            match = re.match(r'^\\s*(\\d+):', line)
+            if match:
+                bad_rec = int(match.group(1))
+    if bad_rec is None:
+        logger.warning(f'Unable to locate bad GRIB2 record in {pathlib.Path(grib_path).name}; leaving file unchanged.')
+        return grib_path
+
+    logger.warning(
+        f'Detected bad GRIB2 record {bad_rec} in {pathlib.Path(grib_path).name}; rebuilding without it.'
+    )
+    grib_path = pathlib.Path(grib_path)
+    clean_path = grib_path.with_suffix(grib_path.suffix + '.clean')
+    if replace_original:
+        clean_path = grib_path.with_suffix(grib_path.suffix + '.clean_tmp')
+
+    part1 = grib_path.with_suffix(grib_path.suffix + '.part1')
+    part2 = grib_path.with_suffix(grib_path.suffix + '.part2')
+    for tmp_path in (part1, part2, clean_path):
+        if tmp_path.exists():
+            try:
+                tmp_path.unlink()
+            except OSError:
+                logger.warning(f'Unable to remove stale file {tmp_path}.')
+
+    if bad_rec > 1:
+        cmd_part1 = [
+            wgrib2_exe,
+            str(grib_path),
+            '-for', f'1:{bad_rec - 1}:1',
+            '-grib', str(part1),
+        ]
+        exec_command(cmd_part1, logger, exit_on_fail=False, verbose=False, wait=True)
+
+    cmd_part2 = [
+        wgrib2_exe,
+        str(grib_path),
+        '-for', f'{bad_rec + 1}:999999:1',
+        '-grib', str(part2),
+    ]
+    exec_command(cmd_part2, logger, exit_on_fail=False, verbose=False, wait=True)
+
+    try:
+        with open(clean_path, 'wb') as out_f:
+            if part1.exists():
+                with open(part1, 'rb') as in_f:
+                    shutil.copyfileobj(in_f, out_f)
+            if part2.exists():
+                with open(part2, 'rb') as in_f:
+                    shutil.copyfileobj(in_f, out_f)
+    except OSError as exc:
+        logger.warning(f'Unable to assemble cleaned GRIB2 file for {grib_path.name}: {exc}')
+        return grib_path
+    finally:
+        for tmp_path in (part1, part2):
+            if tmp_path.exists():
+                try:
+                    tmp_path.unlink()
+                except OSError:
+                    logger.warning(f'Unable to remove temporary file {tmp_path}.')
+
+    if not clean_path.exists() or clean_path.stat().st_size == 0:
+        logger.warning(f'Cleaned GRIB2 file is empty for {grib_path.name}; leaving original unchanged.')
+        return grib_path
+
+    if replace_original:
+        try:
+            clean_path.replace(grib_path)
+        except OSError as exc:
+            logger.warning(f'Unable to replace {grib_path.name} with cleaned version: {exc}')
+            return grib_path
+        return grib_path
+
+    return clean_path
+
+
+def find_wgrib2(logger):
+    wgrib2_exe = shutil.which('wgrib2')
+    if wgrib2_exe:
+        return wgrib2_exe
+    env_candidates = [os.environ.get('WGRIB2'), os.environ.get('WGRIB2_PATH'), os.environ.get('WGRIB2_EXE')]
+    for candidate in env_candidates:
+        if candidate and pathlib.Path(candidate).is_file():
+            return candidate
+    search_roots = [
+        pathlib.Path('/glade/u/apps'),
+        pathlib.Path('/glade/work'),
+    ]
+    for root in search_roots:
+        if not root.exists():
+            continue
+        matches = sorted(root.glob('**/wgrib2*/bin/wgrib2'))
+        if matches:
+            return str(matches[-1])
+    return None
@@ -15,13 +15,14 @@ import sys
 import argparse
 import pathlib
 import datetime as dt
-import numpy as np
-import pandas as pd
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from proc_util import exec_command
+from wps_wrf_util import list_dir_names, link_file
 
 this_file = os.path.basename(__file__)
-logging.basicConfig(format=f'{this_file}: %(asctime)s - %(message)s', level=logging.DEBUG, datefmt='%Y-%m-%dT%H:%M:%S')
+# Relative timestamps need no strftime call, unlike asctime, for each of the per-valid-time log lines
+logging.basicConfig(format=f'{this_file}: %(relativeCreated)d ms - %(message)s', level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
 long_time = 5
@@ -29,6 +30,14 @@ long_long_time = 15
 short_time = 3
 curr_dir=os.path.dirname(os.path.abspath(__file__))
 
+# Number of valid times linked concurrently
+link_workers = 16
+
+# GFS FNL cycle hours, the valid hours of their f03 files, and the supported intervals between files
+synoptic_hours = frozenset(('00', '06', '12', '18'))
+offset3_hours = frozenset(('03', '09', '15', '21'))
+valid_intervals = frozenset((3, 6))
+
 def parse_args():
     ## Parse the command-line arguments
     parser = argparse.ArgumentParser()
@@ -40,12 +49,15 @@ def parse_args():
                         help='string or pathlib.Path object of the local parent directory where all downloaded GFS FNL data should be stored')
     parser.add_argument('-i', '--int_h', default=6, type=int,
                         help='integer number of hours between GFS FNL files to download (default: 6)')
+    parser.add_argument('-l', '--hardlink', action='store_true',
+                        help='hard link rather than symlink to the GLADE files when they are on the same filesystem as the output directory')
 
     args = parser.parse_args()
     cycle_dt = args.cycle_dt
     sim_hrs = args.sim_hrs
     out_dir_parent = args.out_dir_parent
     int_h = args.int_h
+    hardlink = args.hardlink
 
     if len(cycle_dt) != 11:
         log.error('ERROR! Incorrect length for positional argument cycle_dt. Exiting!')
@@ -62,9 +74,9 @@ def parse_args():
     else:
         out_dir_parent = pathlib.Path(out_dir_parent)
 
-    return cycle_dt, sim_hrs, out_dir_parent, int_h
+    return cycle_dt, sim_hrs, out_dir_parent, int_h, hardlink
 
-def main(cycle_dt_str, sim_hrs, out_dir_parent, now_time_beg, interval):
+def main(cycle_dt_str, sim_hrs, out_dir_parent, now_time_beg, interval, hardlink=False):
     log.info(f'Running link_gfs_from_glade.py from directory: {curr_dir}')
 
     # Calculate the desired lead hours for this cycle, accounting for the possible icbc_fc_dt offset.
@@ -80,7 +92,7 @@ def main(cycle_dt_str, sim_hrs, out_dir_parent, now_time_beg, interval):
     fmt_yyyymmddhh = '%Y%m%d%H'
     fmt_yyyymmdd_hh = '%Y%m%d_%H'
 
-    cycle_dt = pd.to_datetime(cycle_dt_str, format=fmt_yyyymmdd_hh)
+    cycle_dt = dt.datetime.strptime(cycle_dt_str, fmt_yyyymmdd_hh)
     cycle_date = cycle_dt.strftime(fmt_yyyymmdd)
     cycle_year = cycle_dt.strftime(fmt_yyyy)
     cycle_month = cycle_dt.strftime(fmt_mm)
@@ -88,75 +100,113 @@ def main(cycle_dt_str, sim_hrs, out_dir_parent, now_time_beg, interval):
 
     # Do some basic error checking for GFS FNL
     # Handle this differently in the future if desired to allow initializing from off-synoptic times
-    if cycle_hour not in ['00', '06', '12', '18']:
+    if cycle_hour not in synoptic_hours:
         log.error('ERROR: When initializing from GFS FNL, please choose a WRF cycle time that starts from 00, 06, 12, or 18 UTC.')
         log.error('Exiting!')
         sys.exit(1)
 
-    if interval not in [3, 6]:
+    if interval not in valid_intervals:
         log.error('ERROR: Please choose either 3 or 6 for the interval when using GFS FNL, not ' + str(interval) + '.')
         log.error('Exiting!')
         sys.exit(1)
 
-    cycle_dt_end = cycle_dt + dt.timedelta(hours=sim_hrs)
-    valid_dt = pd.date_range(start=cycle_dt, end=cycle_dt_end, freq=str(interval) + 'H')
-    n_valid = len(valid_dt)
+    valid_dt = [cycle_dt + dt.timedelta(hours=hh) for hh in range(0, sim_hrs + 1, interval)]
+
+    # Format every date string the loop needs once up front, rather than inside the link workers.
+    # Always grab either the f00 or f03 files for GFS FNL.
+    dates = [valid.strftime(fmt_yyyymmdd) for valid in valid_dt]
+    hhs = [valid.strftime(fmt_hh) for valid in valid_dt]
+    for this_hh in hhs:
+        if this_hh not in synoptic_hours and this_hh not in offset3_hours:
+            log.error('ERROR: this_hh = ' + this_hh + ', which is not a valid value for GFS FNL files.')
+            log.error('Exiting!')
+            sys.exit(1)
+    lead_is_03 = [this_hh in offset3_hours for this_hh in hhs]
+    cycles = [valid - dt.timedelta(hours=3) if is_03 else valid for valid, is_03 in zip(valid_dt, lead_is_03)]
+    cycle_datehhs = [cycle.strftime(fmt_yyyymmddhh) for cycle in cycles]
+    cycle_years = [cycle.strftime(fmt_yyyy) for cycle in cycles]
+    cycle_yearmos = [cycle.strftime(fmt_yyyymm) for cycle in cycles]
+    leads = ['03' if is_03 else '00' for is_03 in lead_is_03]
 
     glade_dir_parent = pathlib.Path('/', 'glade', 'campaign', 'collections', 'rda', 'data', 'd083003')
     # glade_dir = glade_dir_parent.joinpath(cycle_year, cycle_date)
 
-    # Loop over valid times
-    for vv in range(n_valid):
-        this_valid = valid_dt[vv]
-        this_date = this_valid.strftime(fmt_yyyymmdd)
-        this_hh = this_valid.strftime(fmt_hh)
-
-        # Download GFS FNL files into date-specific directories
-        out_dir = out_dir_parent.joinpath('gfs_fnl.' + this_date)
+    # Build each distinct GLADE and output directory Path once; adjacent valid times nearly always share them.
+    # Make each date-specific output directory once, rather than once per valid time.
+    glade_dirs = {}
+    for yr, mo in zip(cycle_years, cycle_yearmos):
+        glade_dirs.setdefault((yr, mo), glade_dir_parent / yr / mo)
+    out_dirs = {this_date: out_dir_parent / f'gfs_fnl.{this_date}' for this_date in dict.fromkeys(dates)}
+    for out_dir in out_dirs.values():
         out_dir.mkdir(parents=True, exist_ok=True)
-        os.chdir(out_dir)
-
-        # Always grab either the f00 or f03 files for GFS FNL
-        if this_hh in ['00', '06', '12', '18']:
-            this_lead = '00'
-            this_cycle = this_valid
-        elif this_hh in ['03', '09', '15', '21']:
-            this_lead = '03'
-            this_cycle = this_valid - dt.timedelta(hours=3)
-        else:
-            log.error('ERROR: this_hh = ' + this_hh + ', which is not a valid value for GFS FNL files.')
-            log.error('Exiting!')
-            sys.exit(1)
 
-        this_cycle_datehh = this_cycle.strftime(fmt_yyyymmddhh)
-        this_cycle_year = this_cycle.strftime(fmt_yyyy)
-        this_cycle_yearmo = this_cycle.strftime(fmt_yyyymm)
+    # One listing per directory replaces a stat per file on GLADE and locally.
+    # The link threads add to the local listings, so that is guarded by a lock.
+    dir_files = {this_dir: list_dir_names(this_dir) for this_dir in (*glade_dirs.values(), *out_dirs.values())}
+    dir_files_lock = threading.Lock()
+
+    # A GLADE directory with files in it obviously exists, so only an empty listing needs a further check.
+    # Warn once about each missing directory, rather than about every file that would be in it.
+    glade_dir_exists = {glade_dir: bool(dir_files[glade_dir]) or os.path.isdir(glade_dir) for glade_dir in glade_dirs.values()}
+    for glade_dir, exists in glade_dir_exists.items():
+        if not exists:
+            log.info('WARNING: Directory ' + str(glade_dir) + ' does not exist. Skipping all IC/LBC times with files in it.')
+
+    # A hard link saves ungrib from resolving a symlink on every open, but cannot cross filesystems,
+    #   so note the device of each directory that exists
+    dir_devs = {}
+    if hardlink:
+        for this_dir in dir_files:
+            if glade_dir_exists.get(this_dir, True):
+                dir_devs[this_dir] = os.stat(this_dir).st_dev
+
+    def _link_one(vv):
+        this_date = dates[vv]
+        this_lead = leads[vv]
+        this_cycle_datehh = cycle_datehhs[vv]
+        this_cycle_year = cycle_years[vv]
+        this_cycle_yearmo = cycle_yearmos[vv]
+
+        # Download GFS FNL files into date-specific directories
+        out_dir = out_dirs[this_date]
 
         # Set the directory
-        glade_dir = glade_dir_parent.joinpath(this_cycle_year, this_cycle_yearmo)
+        glade_dir = glade_dirs[(this_cycle_year, this_cycle_yearmo)]
 
         # Set the GFS FNL filename on GLADE (likely different in other data repos)
-        glade_fname = 'gdas1.fnl0p25.' + this_cycle_datehh + '.f' + this_lead + '.grib2'
-        glade_file = glade_dir.joinpath(glade_fname)
+        glade_fname = f'gdas1.fnl0p25.{this_cycle_datehh}.f{this_lead}.grib2'
+        glade_file = f'{glade_dir}/{glade_fname}'
+        glade_dir_files = dir_files[glade_dir]
+        existing_local = dir_files[out_dir]
+
+        if not glade_dir_exists[glade_dir]:
+            return False
 
         # First, check for the file's existence on GLADE
-        if not glade_file.is_file():
-            log.info('WARNING: File ' + str(glade_file) + ' does not exist. Looping to the next expected IC/LBC time.')
-            continue
+        if glade_fname not in glade_dir_files:
+            log.info('WARNING: File ' + glade_file + ' does not exist. Looping to the next expected IC/LBC time.')
+            return False
 
         # Second, check for the existence of the link/file where ungrib will expect to find it
-        if not out_dir.joinpath(glade_fname).is_file():
-            log.info('Linking to ' + str(glade_file) + ' in ' + str(out_dir))
-            ret,output = exec_command(['ln', '-sf', str(glade_dir.joinpath(glade_fname)), '.'], log)
+        with dir_files_lock:
+            already_linked = glade_fname in existing_local
+            existing_local.add(glade_fname)
+        if not already_linked:
+            log.info('Linking to ' + glade_file + ' in ' + str(out_dir))
+            link_file(glade_file, f'{out_dir}/{glade_fname}', log, hardlink and dir_devs[glade_dir] == dir_devs[out_dir])
         else:
             log.info('   File ' + glade_fname + ' already exists locally. No need to re-link to it on GLADE.')
+        return True
 
+    # Each valid time is independent metadata work (a listing lookup and a symlink), so run them concurrently
+    with ThreadPoolExecutor(max_workers=link_workers) as executor:
+        list(executor.map(_link_one, range(len(valid_dt))))
 
 
 if __name__ == '__main__':
     now_time_beg = dt.datetime.now(dt.UTC)
-    cycle_dt, sim_hrs, out_dir_parent, int_h = parse_args()
-    main(cycle_dt, sim_hrs, out_dir_parent, now_time_beg, int_h)
+    cycle_dt, sim_hrs, out_dir_parent, int_h, hardlink = parse_args()
+    main(cycle_dt, sim_hrs, out_dir_parent, now_time_beg, int_h, hardlink)
     now_time_end = dt.datetime.now(dt.UTC)
     run_time_tot = now_time_end - now_time_beg
     now_time_beg_str = now_time_beg.strftime('%Y-%m-%d %H:%M:%S')
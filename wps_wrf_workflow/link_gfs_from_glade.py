@@ -15,13 +15,14 @@ import sys
 import argparse
 import pathlib
 import datetime as dt
-import numpy as np
-import pandas as pd
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from proc_util import exec_command
+from wps_wrf_util import list_dir_names, link_file
 
 this_file = os.path.basename(__file__)
-logging.basicConfig(format=f'{this_file}: %(asctime)s - %(message)s', level=logging.DEBUG, datefmt='%Y-%m-%dT%H:%M:%S')
+# Stamp records with milliseconds since start-up, which avoids a strftime per log line in the link loop
+logging.basicConfig(format=f'{this_file}: %(relativeCreated)d ms - %(message)s', level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
 long_time = 5
@@ -29,6 +30,9 @@ long_long_time = 15
 short_time = 3
 curr_dir=os.path.dirname(os.path.abspath(__file__))
 
+# Number of lead times linked concurrently
+link_workers = 16
+
 def parse_args():
     ## Parse the command-line arguments
     parser = argparse.ArgumentParser()
@@ -44,6 +48,8 @@ def parse_args():
                         help='resolution of GFS to download (0.25 [default] or 0.5')
     parser.add_argument('-i', '--int_h', default=3, type=int,
                         help='integer number of hours between GFS files to download (default: 3)')
+    parser.add_argument('-l', '--hardlink', action='store_true',
+                        help='hard link rather than symlink to the GLADE files when they are on the same filesystem as the output directory')
 
     args = parser.parse_args()
     cycle_dt = args.cycle_dt
@@ -52,6 +58,7 @@ def parse_args():
     icbc_fc_dt = args.icbc_fc_dt
     resolution = args.resolution
     int_h = args.int_h
+    hardlink = args.hardlink
 
     if len(cycle_dt) != 11:
         log.error('ERROR! Incorrect length for positional argument cycle_dt. Exiting!')
@@ -69,22 +76,21 @@ def parse_args():
     else:
         out_dir = pathlib.Path(out_dir)
 
-    return cycle_dt, sim_hrs, out_dir, icbc_fc_dt, resolution, int_h
+    return cycle_dt, sim_hrs, out_dir, icbc_fc_dt, resolution, int_h, hardlink
 
-def main(cycle_dt_str, sim_hrs, out_dir, icbc_fc_dt, resolution, now_time_beg, interval):
+def main(cycle_dt_str, sim_hrs, out_dir, icbc_fc_dt, resolution, now_time_beg, interval, hardlink=False):
     log.info(f'Running link_gfs_from_glade.py from directory: {curr_dir}')
 
     # Calculate the desired lead hours for this cycle, accounting for the possible icbc_fc_dt offset.
     # Build array of forecast lead times to download. GFS output on GLADE is 3-hourly.
-    leads = np.arange(icbc_fc_dt, sim_hrs + icbc_fc_dt + 1, interval)
-    n_leads = len(leads)
+    leads = range(icbc_fc_dt, sim_hrs + icbc_fc_dt + 1, interval)
 
     fmt_yyyy = '%Y'
     fmt_hh = '%H'
     fmt_yyyymmdd = '%Y%m%d'
     fmt_yyyymmdd_hh = '%Y%m%d_%H'
 
-    cycle_dt = pd.to_datetime(cycle_dt_str, format=fmt_yyyymmdd_hh)
+    cycle_dt = dt.datetime.strptime(cycle_dt_str, fmt_yyyymmdd_hh)
     cycle_date = cycle_dt.strftime(fmt_yyyymmdd)
     cycle_year = cycle_dt.strftime(fmt_yyyy)
     cycle_hour = cycle_dt.strftime(fmt_hh)
@@ -94,35 +100,52 @@ def main(cycle_dt_str, sim_hrs, out_dir, icbc_fc_dt, resolution, now_time_beg, i
     glade_dir = glade_dir_parent.joinpath(cycle_year, cycle_date)
 
     out_dir.mkdir(parents=True, exist_ok=True)
-    os.chdir(out_dir)
 
-    # Loop over lead times
-    for ll in range(n_leads):
-        this_lead = str(leads[ll]).zfill(3)
+    # List both directories once up front rather than stat'ing every file on GLADE and locally
+    glade_dir_files = list_dir_names(glade_dir)
+    existing_local = list_dir_names(out_dir)
+
+    # A hard link saves ungrib from resolving a symlink on every open, but cannot cross filesystems
+    if hardlink and glade_dir_files and os.stat(glade_dir).st_dev != os.stat(out_dir).st_dev:
+        log.info('GLADE and ' + str(out_dir) + ' are on different filesystems. Using symlinks instead of hard links.')
+        hardlink = False
+
+    # Guards existing_local, which the link threads share
+    existing_lock = threading.Lock()
+
+    def _link_one(lead):
+        this_lead = str(lead).zfill(3)
 
         # Note that the filenames for 0.25-deg GFS files on GLADE and AWS differ...
-        fname_glade = 'gfs.0p25.' + cycle_datehh + '.f' + this_lead + '.grib2'
-        fname_aws = 'gfs.t' + cycle_hour + 'z.pgrb2.0p25.f' + this_lead
+        fname_glade = f'gfs.0p25.{cycle_datehh}.f{this_lead}.grib2'
+        fname_aws = f'gfs.t{cycle_hour}z.pgrb2.0p25.f{this_lead}'
         glade_file = glade_dir.joinpath(fname_glade)
 
         # First, check for the file's existence on GLADE
-        if not glade_file.is_file():
+        if fname_glade not in glade_dir_files:
             log.info('WARNING: File ' + str(glade_file) + ' does not exist. Looping to the next expected IC/LBC time.')
-            continue
+            return False
 
         # Second, check for the existence of the link/file where ungrib will expect to find it
-        if not out_dir.joinpath(fname_glade).is_file():
+        with existing_lock:
+            already_linked = fname_glade in existing_local
+            existing_local.add(fname_glade)
+        if not already_linked:
             log.info('Linking to ' + str(glade_file) + ' in ' + str(out_dir))
-            ret,output = exec_command(['ln', '-sf', str(glade_dir.joinpath(fname_glade)), '.'], log)
+            link_file(glade_file, out_dir.joinpath(fname_glade), log, hardlink)
         else:
             log.info('   File ' + fname_glade + ' already exists locally. No need to re-link to it on GLADE.')
+        return True
 
+    # Each lead time is independent metadata work (a listing lookup and a symlink), so run them concurrently
+    with ThreadPoolExecutor(max_workers=link_workers) as executor:
+        list(executor.map(_link_one, leads))
 
 
 if __name__ == '__main__':
     now_time_beg = dt.datetime.now(dt.UTC)
-    cycle_dt, sim_hrs, out_dir, icbc_fc_dt, resolution, int_h = parse_args()
-    main(cycle_dt, sim_hrs, out_dir, icbc_fc_dt, resolution, now_time_beg, int_h)
+    cycle_dt, sim_hrs, out_dir, icbc_fc_dt, resolution, int_h, hardlink = parse_args()
+    main(cycle_dt, sim_hrs, out_dir, icbc_fc_dt, resolution, now_time_beg, int_h, hardlink)
     now_time_end = dt.datetime.now(dt.UTC)
     run_time_tot = now_time_end - now_time_beg
     now_time_beg_str = now_time_beg.strftime('%Y-%m-%d %H:%M:%S')
@@ -1,27 +1,42 @@
 import sys
+import logging
 import subprocess
 
-def exec_command(cmd_list, log, exit_on_fail=True, verbose=True, wait=False):
-    log.info(f'Executing Command: {" ".join([str(arg) for arg in cmd_list])}')
+# Values that are the same for every task in a process pool, handed to each worker process once by
+#   init_worker_context rather than pickled along with every task. Tasks must look this up as
+#   proc_util.worker_context, so that it is the copy in the worker's imported proc_util module.
+worker_context = {}
+
+def init_worker_context(ctx):
+    worker_context.update(ctx)
+
+def exec_command(cmd_list, log, exit_on_fail=True, verbose=True, wait=False, cwd=None):
+    # Only build the command string if it will actually be logged
+    if verbose and log.isEnabledFor(logging.INFO):
+        log.info('Executing Command: %s', ' '.join(map(str, cmd_list)))
+    # subprocess.run already spawns with vfork (Python 3.10+ on Linux) or posix_spawn where it can, so the
+    #   child does not copy this process's page tables. Keep the default close_fds=True; turning it off to
+    #   reach posix_spawn on older Pythons would leak open sockets and log files into every child.
     # Wait for output sent to UNIX PIPE linked between processes
     if wait:
-        result = subprocess.run(cmd_list, capture_output=True, text=True)
+        result = subprocess.run(cmd_list, capture_output=True, text=True, cwd=cwd)
+        # Output only exists to log when it was captured
+        if verbose:
+            if result.stdout:
+                log.debug(f'Command stdout:\n {result.stdout}')
+            if result.stderr:
+                log.error(f'Command stderr:\n {result.stderr}')
     # Send stdout & stderr (including logging) directly to the terminal
+    elif verbose:
+        result = subprocess.run(cmd_list, cwd=cwd)
+    # Nobody reads the output of a quiet command, so don't have the kernel write it anywhere
     else:
-        result = subprocess.run(cmd_list)
-    if result.stdout and verbose:
-        log.debug(f'Command stdout:\n {result.stdout}')
-    if result.stderr and verbose:
-        log.error(f'Command stderr:\n {result.stderr}')
-    try:
-        result.check_returncode()
-    except subprocess.CalledProcessError:
+        result = subprocess.run(cmd_list, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=cwd)
+    if result.returncode:
         if verbose:
-            log.info(f'Error Executing Command: {" ".join([str(arg) for arg in cmd_list])}')
+            log.info('Error Executing Command: %s', ' '.join(map(str, cmd_list)))
             log.error(f'Return Code: {result.returncode}')
         if exit_on_fail:
             log.info("Exiting")
             sys.exit(1)
     return result.returncode, result.stdout
-
-
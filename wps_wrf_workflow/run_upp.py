@@ -48,6 +48,16 @@ long_long_time = 15
 short_time = 3
 curr_dir=os.path.dirname(os.path.abspath(__file__))
 
+# Slurm job states that mean a UPP job will never write its success message
+failed_job_states = frozenset(('FAILED', 'CANCELLED', 'TIMEOUT', 'NODE_FAIL', 'OUT_OF_MEMORY', 'BOOT_FAIL', 'DEADLINE', 'PREEMPTED'))
+
+wrfout_re = re.compile(r'wrfout_d0([0-9])_([0-9]{4})-([0-9]{2})-([0-9]{2})_([0-9]{2}):([0-9]{2}):([0-9]{2})')
+
+# Wildcards filled in by fill_tmpl_wildcards
+tmpl_wildcard_re = re.compile('|'.join(re.escape(wildcard) for wildcard in (
+    'THIS_FILE_NAME', 'RUN_UPP_SCRIPT', 'EXP_NAME', 'WRF_RUN_DIR', 'WORKING_DIR', 'OUTPUT_DIR', 'UPP_DIR',
+    'ITAG_TEMPLATE', 'GRIB2_RSYNC_ARGS', '-d DOMAIN_IDX')))
+
 def list_of_ints(arg):
     return list(map(int, arg.split(',')))
 
@@ -145,19 +155,11 @@ def parseWrfoutFilename(rpath: str):
     """Parse domain and date components out of a wrfout file name -- full paths are allowed here.
     Return parsed components as strings, so they maintain their zero-filled status."""
 
-    pattern = "wrfout_d0(?P<domain>[0-9])_(?P<yr>[0-9]{4})-(?P<mo>[0-9]{2})-(?P<da>[0-9]{2})_(?P<hr>[0-9]{2}):(?P<mn>[0-9]{2}):(?P<sc>[0-9]{2})"
-    m = re.search(pattern, rpath)
-    assert m, "File name didn't match wrfout with date pattern:\n    %s\n    wrfout_d0(?P<domain>[0-9])_(?P<yr>[0-9]{4})-(?P<mo>[0-9]{2})-(?P<da>[0-9]{2})_(?P<hr>[0-9]{2}):(?P<mn>[0-9]{2}):(?P<sc>[0-9]{2})" % rpath
-    d = m.groupdict()
-    domain = d['domain']
-    year = d["yr"]
-    month = d["mo"]
-    day = d["da"]
-    hour = d["hr"]
-    minute = d["mn"]
-    second = d["sc"]
+    m = wrfout_re.search(rpath)
+    assert m, "File name didn't match wrfout with date pattern:\n    %s\n    %s" % (rpath, wrfout_re.pattern)
 
-    return domain, year, month, day, hour, minute, second
+    # domain, year, month, day, hour, minute, second
+    return m.group(1, 2, 3, 4, 5, 6, 7)
 
 def main(cycle_dt: str, exp_name: str, run_dir: Path, working_dir: Path, output_dir: Path, upp_dir: Path, itag_template: Path, sbatch_template: Path, domains: list[int], do_grib2_rsync: bool, grib2_rsync_target: str, no_cleanup: bool):
 
@@ -171,8 +173,8 @@ def main(cycle_dt: str, exp_name: str, run_dir: Path, working_dir: Path, output_
     # Submit the jobs to sbatch
     submitted_jobids = []
     for upp_submitfile in submitfile_paths:
-        ret, output = exec_command(['sbatch', upp_submitfile], log)
-        jobid = output.split('job ')[1].split('\\n')[0].strip()
+        ret, output = exec_command(['sbatch', upp_submitfile], log, wait=True)
+        jobid = output.split('job ')[1].split()[0]
         submitted_jobids.append(jobid)
         log.info(f'Submitted UPP batch job via "sbatch {upp_submitfile}": ' + jobid)
 
@@ -186,14 +188,10 @@ def main(cycle_dt: str, exp_name: str, run_dir: Path, working_dir: Path, output_
     # TODO: Remove after testing run_wrf process monitoring...
     log.info('Checking status of all jobs:')
 
-    for jobid in submitted_jobids:
+    # One squeue query covers every job, rather than a check_job_status.sh subprocess per job
+    for jobid, state in get_job_states(submitted_jobids).items():
         # TODO: Remove after testing run_wrf process monitoring...
-        log.info(f'    Checking job {jobid} status...')
-
-        ret, output = exec_command([f'{curr_dir}/check_job_status.sh', jobid], log)
-
-        # TODO: Remove after testing run_wrf process monitoring...
-        log.info(f'        Got: {ret}')
+        log.info(f'    Job {jobid} status: {state}')
 
     # TODO: Remove after testing run_wrf process monitoring...
     log.info(f'Started {len(submitted_jobids)} jobs.')
@@ -219,6 +217,14 @@ def main(cycle_dt: str, exp_name: str, run_dir: Path, working_dir: Path, output_
 
     timeout = 3600
     t0 = pytime.perf_counter()
+
+    # Only the bytes appended since the previous poll are read from each job log. The tail of the previous
+    #   read is kept so a message split across two reads is still found.
+    job_offsets = {jobid: 0 for jobid in submitted_jobids}
+    job_tails = {jobid: b'' for jobid in submitted_jobids}
+    # squeue is queried at most once per long_time, however quickly the loop below comes around
+    last_squeue = None
+
     while len(submitted_jobids) > 0:
 
 
@@ -233,24 +239,44 @@ def main(cycle_dt: str, exp_name: str, run_dir: Path, working_dir: Path, output_
                 print(f'          Jobid: {remaining_jobid}')
             sys.exit(1)
 
+        # Stop early if Slurm already reports a job as having failed
+        if last_squeue is None or (t1 - last_squeue) >= long_time:
+            last_squeue = t1
+            for jobid, state in get_job_states(submitted_jobids).items():
+                if state in failed_job_states:
+                    log.error(f'    ERROR: UPP job {jobid} has Slurm state {state}.')
+                    log.error('    Consult ' + str(this_path) + '/log_upp.o' + jobid + ' for potential error messages.')
+                    log.error('    Exiting!')
+                    sys.exit(1)
+
         for jobid in submitted_jobids[:]:
             job_log_filename = 'log_upp.o' + jobid
             
             # TODO: Remove after testing run_wrf process monitoring...
             log.info(f'    Checking for "upp_batch.py completed successfully" in {job_log_filename}...')
-            
-            if 'upp_batch.py completed successfully' in open(job_log_filename).read():
+
+            try:
+                with open(job_log_filename, 'rb') as f:
+                    f.seek(job_offsets[jobid])
+                    chunk = f.read()
+            except FileNotFoundError:
+                chunk = b''
+            job_offsets[jobid] += len(chunk)
+            log_data = job_tails[jobid] + chunk
+            job_tails[jobid] = log_data[-64:]
+
+            if b'upp_batch.py completed successfully' in log_data:
                 submitted_jobids.remove(jobid)
                 log.info(f'        SUCCESS! UPP job {jobid} completed successfully. {len(submitted_jobids)} UPP jobs still running...')
                 pytime.sleep(short_time)  # brief pause
             else:
-                # The log files might be empty for a time, which may cause an error if attempting to read it
-                if os.stat(job_log_filename) == 0:
+                # The log files might be empty for a time
+                if job_offsets[jobid] == 0:
                     # TODO: Remove after testing run_wrf process monitoring...
                     log.info(f'    No {job_log_filename} file is present. Sleeping for {long_time} s...')
                     pytime.sleep(long_time)
                 else:
-                    if os.path.exists(job_log_filename) and 'ERROR' in open(job_log_filename).read():
+                    if b'ERROR' in log_data:
                         log.error('    ERROR: UPP failed.')
                         log.error('    Consult ' + str(this_path) + '/' + job_log_filename + ' for potential error messages.')
                         log.error('    Exiting!')
@@ -265,6 +291,14 @@ def main(cycle_dt: str, exp_name: str, run_dir: Path, working_dir: Path, output_
     return success
 
 
+def get_job_states(jobids):
+    """Return a {jobid: state} dict for the jobids still known to squeue, from a single squeue call."""
+    # This runs while polling, so keep it quiet. squeue exits nonzero once none of the jobs are queued any more.
+    ret, output = exec_command(['squeue', '-h', '-o', '%i %T', '-j', ','.join(jobids)], log, exit_on_fail=False, verbose=False, wait=True)
+    if ret != 0 or not output:
+        return {}
+    return dict(line.split() for line in output.splitlines() if line)
+
 def create_sbatch_files_from_tmpl(submit_upp_tmpl: pathlib.Path, cycle_str: str, run_upp_script: pathlib.Path, wrf_run_dir: pathlib.Path, exp_name: str, working_dir: pathlib.Path, output_dir: pathlib.Path, upp_dir: pathlib.Path, itag_tmpl: pathlib.Path, domains: list[str], do_grib2_rsync: bool, grib2_rsync_target: str, no_cleanup: bool):
     submitfile_paths = []
 
@@ -281,35 +315,34 @@ def create_sbatch_files_from_tmpl(submit_upp_tmpl: pathlib.Path, cycle_str: str,
     return submitfile_paths
 
 def fill_tmpl_wildcards(tmpl_path: str, submit_file_path: str, run_upp_script: pathlib.Path, wrf_run_dir: pathlib.Path, exp_name: str, working_dir: pathlib.Path, output_dir: pathlib.Path, upp_dir: pathlib.Path, itag_tmpl: pathlib.Path, domain: str, do_grib2_rsync: bool, grib2_rsync_target: str, no_cleanup: bool):
-    tmpl = open(tmpl_path, 'r')
-    submit_file = open(submit_file_path, 'w')
-    for line in tmpl:
-        line = line.replace("THIS_FILE_NAME", str(submit_file_path))
-        line = line.replace("RUN_UPP_SCRIPT", str(run_upp_script))
-        line = line.replace("EXP_NAME", exp_name)
-        line = line.replace("WRF_RUN_DIR", str(wrf_run_dir))
-        line = line.replace("WORKING_DIR", str(working_dir))
-        line = line.replace("OUTPUT_DIR", str(output_dir))
-        line = line.replace("UPP_DIR", str(upp_dir))
-        line = line.replace("ITAG_TEMPLATE", str(itag_tmpl))
-        if do_grib2_rsync and len(grib2_rsync_target) > 2:
-            line = line.replace("GRIB2_RSYNC_ARGS", f'-g {grib2_rsync_target}')
-        else:
-            line = line.replace("GRIB2_RSYNC_ARGS", '')
-
-        if len(domain) < 1:
-            if no_cleanup:
-                line = line.replace("-d DOMAIN_IDX", '-N')
-            else:
-                line = line.replace("-d DOMAIN_IDX", '')
-        else:
-            if no_cleanup:
-                line = line.replace("-d DOMAIN_IDX", f'-d {domain} -N')
-            else:
-                line = line.replace("-d DOMAIN_IDX", f'-d {domain}')
+    if do_grib2_rsync and len(grib2_rsync_target) > 2:
+        grib2_rsync_args = f'-g {grib2_rsync_target}'
+    else:
+        grib2_rsync_args = ''
+
+    if len(domain) < 1:
+        domain_args = '-N' if no_cleanup else ''
+    else:
+        domain_args = f'-d {domain} -N' if no_cleanup else f'-d {domain}'
+
+    replacements = {
+        'THIS_FILE_NAME': str(submit_file_path),
+        'RUN_UPP_SCRIPT': str(run_upp_script),
+        'EXP_NAME': exp_name,
+        'WRF_RUN_DIR': str(wrf_run_dir),
+        'WORKING_DIR': str(working_dir),
+        'OUTPUT_DIR': str(output_dir),
+        'UPP_DIR': str(upp_dir),
+        'ITAG_TEMPLATE': str(itag_tmpl),
+        'GRIB2_RSYNC_ARGS': grib2_rsync_args,
+        '-d DOMAIN_IDX': domain_args,
+    }
 
-        submit_file.write(line)
-    submit_file.close()
+    # Fill every wildcard in one pass over the whole template
+    with open(tmpl_path, 'r') as tmpl:
+        tmpl_text = tmpl.read()
+    with open(submit_file_path, 'w') as submit_file:
+        submit_file.write(tmpl_wildcard_re.sub(lambda m: replacements[m.group(0)], tmpl_text))
 
     return submit_file_path
 
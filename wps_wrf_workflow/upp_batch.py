@@ -8,25 +8,23 @@ Created on: 14 August 2023
 
 Process many wrfout files as a single parallel job. Suitable for running on a single node of the cluster.
 Can be called on the entire WRF output directory, or individual domains in the output.
-Breaks the job into single-file tasks and executes them with joblib.
+Breaks the job into single-file tasks and executes them with joblib's loky process pool.
 '''
 
 import os
 import sys
 import re
-import joblib
-from pathlib import Path
+from collections import defaultdict, deque
+from joblib.externals.loky import get_reusable_executor
 
-import math
 import time as pytime
 import shutil
 import argparse
 import pathlib
-import glob
 import datetime as dt
 import logging
-import yaml
 
+import proc_util
 from proc_util import exec_command
 
 # Set this to True to have each parallel process log to 'UPP_debug.log'.
@@ -39,6 +37,21 @@ logging.basicConfig(format=f'{this_file}: %(asctime)s - %(message)s',
 log = logging.getLogger(__name__)
 curr_dir=os.path.dirname(os.path.abspath(__file__))
 
+wrfout_re = re.compile(r'wrfout_d0([0-9])_([0-9]{4})-([0-9]{2})-([0-9]{2})_([0-9]{2}):([0-9]{2}):([0-9]{2})')
+upp_re = re.compile(r'(?P<prefix>.*)\.GrbF.*')
+
+# Files linked into each UPP processing dir from the UPP build's parm dir, as (link name, parm file name).
+# TODO: Note the name change for postxconfig -- we probably want to parameterize this so user can specify different output configs.
+upp_parm_links = (('postxconfig-NT.txt', 'postxconfig-NT-ipc.txt'),
+                  ('post_avblflds.xml', 'post_avblflds.xml'),
+                  ('params_grib2_tbl_new', 'params_grib2_tbl_new'),
+                  ('nam_micro_lookup.dat', 'nam_micro_lookup.dat'),
+                  ('hires_micro_lookup.dat', 'hires_micro_lookup.dat'))
+
+# GRIB2 is already compressed and the files are new at the target, so skip rsync's compression and delta transfer.
+# (No --inplace: the LDM ingester must only ever see complete files, which rsync's temp-file-and-rename guarantees.)
+rsync_opts = ['-av', '--whole-file', '--no-compress']
+
 def parse_args():
     yaml_config_help = {
      # 'run_dir': 'string or Path object of the WRF run directory holding the wrfout files to be processed (default: ./)',
@@ -90,7 +103,12 @@ def parse_args():
     return params
 
 def setup_logging():
-    """Set up logging (for child workers)."""
+    """Set up logging (for child workers). Only the first call in each worker process adds a handler."""
+    # A worker runs many tasks. Once its root logger has a handler, don't open another file just for basicConfig to ignore it.
+    # (Check the logging module's state, rather than a flag here, since this module's globals are not kept between tasks.)
+    if logging.getLogger().handlers:
+        return logging.getLogger(__name__)
+
     if debug:
         file_handler = logging.FileHandler(filename="UPP_debug.log")
     else:
@@ -113,21 +131,13 @@ def parseWrfoutFilename(rpath: str):
     """Parse domain and date components out of a wrfout file name -- full paths are allowed here.
     Return parsed components as strings, so they maintain their zero-filled status."""
 
-    pattern = "wrfout_d0(?P<domain>[0-9])_(?P<yr>[0-9]{4})-(?P<mo>[0-9]{2})-(?P<da>[0-9]{2})_(?P<hr>[0-9]{2}):(?P<mn>[0-9]{2}):(?P<sc>[0-9]{2})"
-    m = re.search(pattern, rpath)
-    assert m, "File name didn't match wrfout with date pattern:\n    %s\n    wrfout_d0(?P<domain>[0-9])_(?P<yr>[0-9]{4})-(?P<mo>[0-9]{2})-(?P<da>[0-9]{2})_(?P<hr>[0-9]{2}):(?P<mn>[0-9]{2}):(?P<sc>[0-9]{2})" % rpath
-    d = m.groupdict()
-    domain = d['domain']
-    year = d["yr"]
-    month = d["mo"]
-    day = d["da"]
-    hour = d["hr"]
-    minute = d["mn"]
-    second = d["sc"]
+    m = wrfout_re.search(rpath)
+    assert m, "File name didn't match wrfout with date pattern:\n    %s\n    %s" % (rpath, wrfout_re.pattern)
 
-    return domain, year, month, day, hour, minute, second
+    # domain, year, month, day, hour, minute, second
+    return m.group(1, 2, 3, 4, 5, 6, 7)
 
-def main(exp_name: str, run_dir: Path, working_dir: Path, output_dir: Path, upp_dir: Path, itag_template: Path, domain_idx: int, grib2_rsync_target: str, no_cleanup: bool):
+def main(exp_name: str, run_dir: pathlib.Path, working_dir: pathlib.Path, output_dir: pathlib.Path, upp_dir: pathlib.Path, itag_template: pathlib.Path, domain_idx: int, grib2_rsync_target: str, no_cleanup: bool):
 
     log.info(f'Running upp_batch.py from directory: {curr_dir}')
 
@@ -140,27 +150,36 @@ def main(exp_name: str, run_dir: Path, working_dir: Path, output_dir: Path, upp_
     upp_exec_dir = pathlib.Path(f'{upp_dir}/exec')
     upp_exec = pathlib.Path(f'{upp_exec_dir}/upp.x')
 
+    # Check the inputs every task will need now, rather than having each of the 48 workers fail on them
+    for required_path in (upp_exec, upp_parm_dir, itag_template):
+        if not os.path.exists(required_path):
+            log.error(f'ERROR: {required_path} does not exist. Exiting!')
+            sys.exit(1)
+
     domain_str = '' if domain_idx == 0 else f'{domain_idx}'
 
     # Include 30-minute files
     # rpaths = glob.glob(os.path.join(run_dir, f"wrfout_d0{domain_str}*"))
 
     # Process only hourly files
-    rpaths = glob.glob(os.path.join(run_dir, f"wrfout_d0{domain_str}*:00:00"))
-
-    rpaths.sort()
+    prefix = f'wrfout_d0{domain_str}'
+    rpaths_by_domain = list_hourly_wrfout_files(run_dir)
+    if domain_str:
+        rpaths = rpaths_by_domain.get(domain_str, [])
+    else:
+        rpaths = [rpath for domain in sorted(rpaths_by_domain) for rpath in rpaths_by_domain[domain]]
+    if len(rpaths) < 1:
+        log.info(f'Found no wrfout files matching {prefix}*:00:00 in wrf run dir: {run_dir}')
+        success = False
+        return success
 
     log.info(f'Found {len(rpaths)} wrfout files in wrf run dir: {run_dir}')
-    match = os.path.join(run_dir, f"wrfout_d0{domain_str}*")
-    log.info(f'    glob match: {match}')
+    match = os.path.join(run_dir, f"{prefix}*:00:00")
+    log.info(f'    match: {match}')
 
     # Generate a model run datetime based on the first rpath (assume this contains the model init time).
     #   This is used to generate output filenames, because a bug in UPP creates filenames
     #     like "WRFPRS.GrbF**.30" for output timesteps on the half hour that have a three-digit forecast hour.
-    if len(rpaths) < 1:
-        success = False
-        return success
-        sys.exit(1)
     init_file = rpaths[0]
     domain, year, month, day, hour, minute, second = parseWrfoutFilename(init_file)
     run_datetime = dt.datetime(year=int(year), month=int(month), day=int(day), hour=int(hour), minute=int(minute))
@@ -170,39 +189,48 @@ def main(exp_name: str, run_dir: Path, working_dir: Path, output_dir: Path, upp_
         tmp_output_dir = construct_output_path_for_run(output_dir, run_datetime, exp_name)
         tmp_day_dir = run_datetime.strftime("%Y%m%d")
         log.info(f'This process will attempt to rsync grib2 output using the command:')
-        log.info(f'    rsync -avz {tmp_output_dir} {grib2_rsync_target}/{tmp_day_dir}/')
+        log.info(f'    rsync {" ".join(rsync_opts)} {tmp_output_dir} {grib2_rsync_target}/{tmp_day_dir}/')
 
     # TODO: Truncate list of files to process (for testing)...
     # rpaths = rpaths[0: 1]
     # rpaths = rpaths[0: 5]
 
-    log.info(f'Processing {len(rpaths)} wrfout files...')
-    for wrfout in rpaths:
-        log.info(f'    {wrfout}')
+    # One log record for the whole list, rather than one per file
+    log.info('Processing %d wrfout files...\n    %s', len(rpaths), '\n    '.join(rpaths))
 
-    jobs = (joblib.delayed(prep_and_run_upp)(run_datetime, exp_name, rpath, working_dir, output_dir, itag_template, upp_parm_dir, upp_exec, no_cleanup) for rpath in rpaths)
-    joblib.Parallel(n_jobs=48)(jobs)
+    # Every task shares the same run-wide arguments, so each worker process receives them once when it starts,
+    #   and each task is sent nothing but its wrfout path. Plain strings pickle smaller than Path objects.
+    # The itag template is read here once and its text handed over, rather than re-read for every wrfout file.
+    # The run's tmp and output dirs are likewise worked out here once, rather than in every task.
+    # /ipcshare/ncar-ensemble/upp-tmp/upp_20230901/06z-WRF-mem01
+    parent_processing_dir = construct_output_path_for_run(working_dir, run_datetime, exp_name, is_working_dir=True)
+    final_output_dir = construct_output_path_for_run(output_dir, run_datetime, exp_name)
+    with open(itag_template, 'r') as f_itag_in:
+        itag_text = f_itag_in.read()
+    upp_ctx = {'run_datetime': run_datetime, 'parent_processing_dir': str(parent_processing_dir),
+               'final_output_dir': str(final_output_dir), 'itag_text': itag_text, 'upp_parm_dir': str(upp_parm_dir), 'upp_exec': str(upp_exec),
+               'suppress_cleanup': no_cleanup}
+    executor = get_reusable_executor(max_workers=48, initializer=proc_util.init_worker_context, initargs=(upp_ctx,))
+    # Each UPP task takes tens of seconds, so send them to workers one at a time, and
+    #   drain the results as they finish (into a zero-length deque) rather than collecting a list of Nones.
+    deque(executor.map(prep_and_run_upp, rpaths), maxlen=0)
 
     # Cleanup (unless this is suppressed for debugging purposes)
-    parent_processing_dir = construct_output_path_for_run(working_dir, run_datetime, exp_name, is_working_dir=True)
     if not no_cleanup:
-        run_identifier = run_datetime.strftime("%Y%m%d_%H")
-        # No!
-        # parent_processing_dir = f'{working_dir}/{run_identifier}'
-
-        # /ipcshare/ncar-ensemble/upp-tmp/upp_20230901/06z-WRF-mem01
-        parent_processing_dir = construct_output_path_for_run(working_dir, run_datetime, exp_name, is_working_dir=True)
         log.info(f'Done processing {len(rpaths)} wrfout files. Removing parent tmp dir for this run: {parent_processing_dir}')
-        shutil.rmtree(parent_processing_dir)
+        # Each wrfout file has its own processing dir, so remove them in parallel on the same (already running) workers
+        with os.scandir(parent_processing_dir) as entries:
+            child_dirs = [entry.path for entry in entries]
+        deque(executor.map(shutil.rmtree, child_dirs), maxlen=0)
+        os.rmdir(parent_processing_dir)
 
     if len(grib2_rsync_target) > 2:
         # Copy output directory to borah-ldm001:/data/GRIBMET/BORAH/<day_dir>/
         # Use this method to copy the whole directory after all the files are created.
         t0 = pytime.perf_counter()
-        final_output_dir = construct_output_path_for_run(output_dir, run_datetime, exp_name)
         day_dir = run_datetime.strftime("%Y%m%d")
         log.info(f'Using rsync to copy files from {final_output_dir} to {grib2_rsync_target}/{day_dir}/')
-        ret, output = exec_command(['rsync', '-avz', final_output_dir, f'{grib2_rsync_target}/{day_dir}/'], log)
+        ret, output = exec_command(['rsync', *rsync_opts, final_output_dir, f'{grib2_rsync_target}/{day_dir}/'], log)
 
         t1 = pytime.perf_counter()
         log.info("  Time to copy grib2 output to /data/GRIBMET/BORAH/: %s", round(t1 - t0, 3))
@@ -210,8 +238,27 @@ def main(exp_name: str, run_dir: Path, working_dir: Path, output_dir: Path, upp_
     success = True
     return success
 
-def prep_and_run_upp(run_datetime: dt.datetime, exp_name: str, rpath: str, working_dir: Path, output_dir: Path, itag_template: Path, upp_parm_dir: Path, upp_exec: Path, suppress_cleanup: bool):
-    """Process netCDF at ``rpath`` by running UPP."""
+def list_hourly_wrfout_files(run_dir):
+    '''
+        Bucket the hourly wrfout files in run_dir by domain number (as a string), each bucket sorted by time.
+        One directory listing filtered on the names serves every domain, and is cheaper than a glob per domain.
+    '''
+    rpaths_by_domain = defaultdict(list)
+    with os.scandir(run_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith('wrfout_d0') and name.endswith(':00:00') and entry.is_file():
+                rpaths_by_domain[name[9]].append(os.path.join(run_dir, name))
+    for rpaths in rpaths_by_domain.values():
+        rpaths.sort()
+    return rpaths_by_domain
+
+def prep_and_run_upp(rpath: str):
+    """Process netCDF at ``rpath`` by running UPP. The run-wide settings come from the worker's context."""
+
+    ctx = proc_util.worker_context
+    run_datetime, parent_processing_dir, final_output_dir = ctx['run_datetime'], ctx['parent_processing_dir'], ctx['final_output_dir']
+    itag_text, upp_parm_dir, upp_exec, suppress_cleanup = ctx['itag_text'], ctx['upp_parm_dir'], ctx['upp_exec'], ctx['suppress_cleanup']
 
     logger = setup_logging()
 
@@ -228,70 +275,51 @@ def prep_and_run_upp(run_datetime: dt.datetime, exp_name: str, rpath: str, worki
     wrfout_filename = os.path.basename(rpath)
 
     # Create processing dir for this job
-    parent_processing_dir = construct_output_path_for_run(working_dir, run_datetime, exp_name, is_working_dir=True)
-    processing_dir = pathlib.Path(f"{parent_processing_dir}/{wrfout_filename}")
-    if processing_dir.exists():
+    processing_dir = f'{parent_processing_dir}/{wrfout_filename}'
+    if os.path.exists(processing_dir):
         shutil.rmtree(processing_dir)
-    processing_dir.mkdir(parents=True, exist_ok=True)
+    os.makedirs(processing_dir, exist_ok=True)
 
     # Create an itag file from the itag_template_file
-    f_itag_in = open(itag_template, 'r')
-    f_itag = open(f'{processing_dir}/itag', 'w')
-    for line in f_itag_in:
-        # Substitute fileName='FILE_NAME' with fileName='/path/to/wrfout_blah'
-        line = line.replace("FILE_NAME", rpath)
-        # Substitute DateStr='DATE_STR' with something like DateStr='2022-08-03_08:30:00'
-        line = line.replace("DATE_STR", f'{year}-{month}-{day}_{hour}:{minute}:{second}')
-
-        # Alternate method, now that we have a datetime for this file...
-        # this_datetime_str = this_datetime.strftime("%Y-%m-%d_%H:%M:%S")
-        # line = line.replace("DATE_STR", f'{year}-{month}-{day}_{hour}:{minute}:{second}')
-
-        f_itag.write(line)
-    f_itag.close()
+    # Substitute fileName='FILE_NAME' with fileName='/path/to/wrfout_blah',
+    #   and DateStr='DATE_STR' with something like DateStr='2022-08-03_08:30:00'
+    date_str = f'{year}-{month}-{day}_{hour}:{minute}:{second}'
+    itag_text = itag_text.replace("FILE_NAME", rpath).replace("DATE_STR", date_str)
+    with open(f'{processing_dir}/itag', 'w') as f_itag:
+        f_itag.write(itag_text)
 
     # Link in params from the UPP build area
 
-    # TODO: Note the name change for this file -- we probably want to parameterize this so user can specify different output configs.
-    # Note the Path.symlink_to() is reversed from unix, where mv and ln both follow the same direction.
-    Path(f'{processing_dir}/postxconfig-NT.txt').symlink_to(Path(f'{upp_parm_dir}/postxconfig-NT-ipc.txt'))
-    # os.symlink(f'{upp_parm_dir}/postxconfig-NT-ipc.txt', f'{processing_dir}/postxconfig-NT.txt')
-
-    Path(f'{processing_dir}/post_avblflds.xml').symlink_to(Path(f'{upp_parm_dir}/post_avblflds.xml'))
-    Path(f'{processing_dir}/params_grib2_tbl_new').symlink_to(Path(f'{upp_parm_dir}/params_grib2_tbl_new'))
-    Path(f'{processing_dir}/nam_micro_lookup.dat').symlink_to(Path(f'{upp_parm_dir}/nam_micro_lookup.dat'))
-    Path(f'{processing_dir}/hires_micro_lookup.dat').symlink_to(Path(f'{upp_parm_dir}/hires_micro_lookup.dat'))
+    for link_name, parm_name in upp_parm_links:
+        os.symlink(f'{upp_parm_dir}/{parm_name}', f'{processing_dir}/{link_name}')
 
     t1 = pytime.perf_counter()
 
     # Run UPP
     # ret, output = exec_command(['sbatch', 'submit_upp.bash'], log)
     # >> / ipchome / pmccarthy / SRW_build / UPP / exec / upp.x & > upp.log
-    os.chdir(processing_dir)
-    ret, output = exec_command([upp_exec], logger)
+    # Run upp.x from the processing dir without changing this (reused) worker process's own cwd
+    ret, output = exec_command([upp_exec], logger, cwd=processing_dir)
 
     # Move output from this job to output_dir
-    # final_output_dir = pathlib.Path(f"{output_dir}/{run_identifier}")
-    final_output_dir = construct_output_path_for_run(output_dir, run_datetime, exp_name)
-
     # if final_output_dir.exists():
     #     shutil.rmtree(final_output_dir)
-    final_output_dir.mkdir(parents=True, exist_ok=True)
-    gribfiles = glob.glob(f"{processing_dir}/WRFPRS.*")
+    os.makedirs(final_output_dir, exist_ok=True)
+    with os.scandir(processing_dir) as entries:
+        gribfiles = [entry.path for entry in entries if entry.name.startswith('WRFPRS.')]
     if len(gribfiles) == 1:
-        src_file = Path(gribfiles.pop())
+        src_file = gribfiles[0]
         src_file_name = os.path.basename(src_file)
 
         # Bug in UPP produces filenames like "WRFPRS.GrbF**.30" for output timesteps on the
         #   half hour that have a three-digit forecast hour.
         #
         # Calculate the forecast hour and minutes and manually create a valid filename.
-        diff = this_datetime - run_datetime
-        total_hours = (diff.days * 24 + math.floor(diff.seconds / 3600))
-        extra_mins = (diff.days*1440 + diff.seconds/60) % 60
-        upp_pattern = '(?P<prefix>.*)\\.GrbF.*'
-        upp_m = re.search(upp_pattern, src_file_name)
-        assert upp_m, "File name didn't match wrfout with date pattern:\n    %s\n    (?P<prefix>.*)\\.GrbF.*" % src_file_name
+        total_seconds = int((this_datetime - run_datetime).total_seconds())
+        total_hours, rem_seconds = divmod(total_seconds, 3600)
+        extra_mins = rem_seconds // 60
+        upp_m = upp_re.search(src_file_name)
+        assert upp_m, "File name didn't match wrfout with date pattern:\n    %s\n    %s" % (src_file_name, upp_re.pattern)
         upp_d = upp_m.groupdict()
         prefix = upp_d['prefix']
 
@@ -299,14 +327,20 @@ def prep_and_run_upp(run_datetime: dt.datetime, exp_name: str, rpath: str, worki
         # Leave the .minutes off if forecast length has hours only.
         extra_mins_str = ''
         if extra_mins > 0:
-            extra_mins_str = f'.{int(extra_mins):02}'
+            extra_mins_str = f'.{extra_mins:02}'
         corrected_file_name = f'{prefix}_d0{domain}.{total_hours:03}{extra_mins_str}.grib2'
 
-        dst_file = Path(f'{final_output_dir}/{corrected_file_name}')
+        dst_file = f'{final_output_dir}/{corrected_file_name}'
         if suppress_cleanup:
-            shutil.copy(src_file, dst_file)
+            # Keep the original in the processing dir. A hard link is a metadata-only copy, when both dirs share a filesystem.
+            try:
+                if os.path.lexists(dst_file):
+                    os.unlink(dst_file)
+                os.link(src_file, dst_file)
+            except OSError:
+                shutil.copy(src_file, dst_file)
         else:
-          src_file.rename(dst_file)
+            os.replace(src_file, dst_file)
     else:
         logger.error(f'UPP produced {len(gribfiles)} files. Not moving file to output directory.')
 
@@ -1,8 +1,20 @@
+import os
+import sys
+import errno
+import mmap
+
+
 def search_file(filename, pat):
     '''
-    Searches for pattern in an ascii file
+    Searches for pattern in an ascii file, scanning the mapped bytes rather than reading the file into a str
     '''
-    return pat in peek_file(filename)
+    pat_b = pat.encode() if isinstance(pat, str) else pat
+    with open(filename, 'rb') as f:
+        # mmap cannot map an empty file, which could not contain the pattern anyway
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm.find(pat_b) != -1
 
 
 def peek_file(filename):
@@ -12,3 +24,47 @@ def peek_file(filename):
     with open(filename) as f:
         s = f.read()
     return s
+
+
+def list_dir_names(dirname):
+    '''
+    Returns the set of entry names in a directory from a single listing (empty if the directory is missing)
+    '''
+    try:
+        with os.scandir(dirname) as it:
+            return {entry.name for entry in it}
+    except FileNotFoundError:
+        return set()
+
+
+def link_file(target, link_path, log, hardlink=False):
+    '''
+    Equivalent of "ln -sf target link_path" (or "ln -f" if hardlink) without spawning a subprocess.
+    A hard link that the filesystem refuses (EXDEV across filesystems, EPERM under protected_hardlinks)
+    falls back to a symlink.
+    '''
+    try:
+        if hardlink:
+            try:
+                force_link(os.link, target, link_path)
+                return
+            except OSError as exc:
+                if exc.errno not in (errno.EXDEV, errno.EPERM):
+                    raise
+                log.warning('WARNING: Unable to hard link ' + str(target) + ' (' + exc.strerror + '). Symlinking to it instead.')
+        force_link(os.symlink, target, link_path)
+    except OSError as exc:
+        log.error('ERROR: Unable to link ' + str(target) + ' to ' + str(link_path) + ': ' + str(exc))
+        log.error('Exiting!')
+        sys.exit(1)
+
+
+def force_link(make_link, target, link_path):
+    '''
+    Create link_path with make_link (os.link or os.symlink), replacing whatever is already there
+    '''
+    try:
+        make_link(target, link_path)
+    except FileExistsError:
+        os.unlink(link_path)
+        make_link(target, link_path)